@@ -0,0 +1,168 @@
+"""align.py: tile-wise src/dst misalignment estimation and correction"""
+__author__      = "Minyoung Kim"
+__license__ = "MIT"
+__maintainer__ = "Minyoung Kim"
+__email__ = "minykim@mit.edu"
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+from tqdm import tqdm
+
+from bmtrap.util import bounded_map
+
+
+def downsample_mean(array, factor):
+    """downsample a 3D array by block averaging (trailing voxels are dropped)
+    :param array: 3D array
+    :param factor: (z, y, x) integer downsampling factor
+    """
+    f = np.asarray(factor)
+    n = np.asarray(array.shape) // f
+    array = array[:n[0]*f[0], :n[1]*f[1], :n[2]*f[2]].astype(np.float32)
+    return array.reshape(n[0], f[0], n[1], f[1], n[2], f[2]).mean(axis=(1, 3, 5))
+
+
+def phase_correlation(src, dst):
+    """shift of dst with respect to src by phase correlation (dst(p + shift) ~ src(p))
+    :param src: 3D array
+    :param dst: 3D array of the same shape
+    :return: (shift with sub-voxel precision, peak height in [0, 1])
+    """
+    # Hann window against edge effects
+    window = np.ones(src.shape, dtype=np.float32)
+    for axis, n in enumerate(src.shape):
+        if n > 2:
+            shape = [1, 1, 1]
+            shape[axis] = n
+            window = window * np.hanning(n).reshape(shape)
+
+    fs = np.fft.rfftn((src - src.mean()) * window)
+    fd = np.fft.rfftn((dst - dst.mean()) * window)
+    cross = fd * np.conj(fs)
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.irfftn(cross, s=src.shape)
+
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = np.zeros(3)
+    for axis, n in enumerate(corr.shape):
+        p = peak[axis]
+        sub = 0.0
+        if n > 2:
+            # parabolic fit around the peak (with wrap-around)
+            before, after = list(peak), list(peak)
+            before[axis] = (p - 1) % n
+            after[axis] = (p + 1) % n
+            c0, c1, c2 = corr[tuple(before)], corr[peak], corr[tuple(after)]
+            denom = c0 - 2 * c1 + c2
+            if denom != 0:
+                sub = 0.5 * (c0 - c2) / denom
+        shift[axis] = (p if p <= n // 2 else p - n) + sub
+
+    return shift, float(corr[peak])
+
+
+def estimate_offsets(src_vol, dst_vol, tile_size=(64, 1024, 1024), downsample=(1, 4, 4),
+                     n_workers=4, min_quality=0.05, out_path=None):
+    """estimate per-tile src -> dst offsets by phase correlation on downsampled tiles
+
+    Tiles are processed by a pool of workers and only a few are held in memory
+    at once. Tiles whose correlation peak is below min_quality (e.g. empty
+    background) get the median offset of the other tiles.
+
+    :param src_vol: source volume (e.g. tdTomato)
+    :param dst_vol: destination volume (e.g. cFos) of the same shape
+    :param tile_size: (z, y, x) tile size in full-resolution voxels
+    :param downsample: (z, y, x) downsampling factor applied to each tile
+    :param n_workers: number of worker threads
+    :param min_quality: minimum correlation peak for a tile offset to be trusted
+    :param out_path: save the offset map (.npz) if given
+    :return: offset map (dict: offsets, quality, valid, tile_size and
+             centres_z/y/x, the voxel coordinates of the tile centres per axis)
+    """
+    if tuple(src_vol.shape[:3]) != tuple(dst_vol.shape[:3]):
+        raise ValueError("src and dst volumes must have the same shape: %s != %s"
+                         % (tuple(src_vol.shape[:3]), tuple(dst_vol.shape[:3])))
+    shape = np.asarray(src_vol.shape[:3])
+    tile_size = np.asarray(tile_size)
+    downsample = np.asarray(downsample)
+    n_tiles = tuple(int(n) for n in np.ceil(shape / tile_size))
+
+    # centres of the (possibly partial) tiles along each axis
+    centres = []
+    for n, ts, size in zip(n_tiles, tile_size, shape):
+        lo = np.arange(n) * ts
+        hi = np.minimum(lo + ts, size)
+        centres.append((lo + hi - 1) / 2.0)
+
+    def work(t):
+        lo = np.asarray(t) * tile_size
+        hi = np.minimum(lo + tile_size, shape)
+        sl = tuple(slice(a, b) for a, b in zip(lo, hi))
+        src = downsample_mean(np.asarray(src_vol[sl]), downsample)
+        dst = downsample_mean(np.asarray(dst_vol[sl]), downsample)
+        if min(src.shape) == 0 or src.std() == 0 or dst.std() == 0:
+            return t, np.zeros(3), 0.0
+        shift, quality = phase_correlation(src, dst)
+        return t, shift * downsample, quality
+
+    offsets = np.zeros(n_tiles + (3,), dtype=np.float32)
+    quality = np.zeros(n_tiles, dtype=np.float32)
+    tiles = list(itertools.product(*[range(n) for n in n_tiles]))
+    with ThreadPoolExecutor(n_workers) as ex:
+        for t, shift, q in tqdm(bounded_map(ex, work, tiles, 2 * n_workers),
+                                "Offsets", total=len(tiles)):
+            offsets[t] = shift
+            quality[t] = q
+
+    valid = quality >= min_quality
+    fill = np.median(offsets[valid], axis=0) if np.any(valid) else np.zeros(3)
+    offsets[~valid] = fill
+
+    offset_map = {"offsets": offsets, "quality": quality, "valid": valid,
+                  "tile_size": tile_size, "centres_z": centres[0],
+                  "centres_y": centres[1], "centres_x": centres[2]}
+    if out_path is not None:
+        save_offsets(offset_map, out_path)
+
+    return offset_map
+
+
+def save_offsets(offset_map, out_path):
+    """save an offset map into .npz"""
+    np.savez(out_path, **offset_map)
+
+
+def load_offsets(path):
+    """load an offset map saved by save_offsets()"""
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def apply_offsets(cc, offset_map):
+    """move src cell coordinates into dst space with the interpolated offset field
+
+    Offsets are defined at tile centres and interpolated trilinearly
+    (constant beyond the outer tile centres).
+
+    :param cc: Nx3 (z, y, x) source cell coordinates
+    :param offset_map: offset map from estimate_offsets() / load_offsets()
+    :return: Nx3 float coordinates in the destination volume (use them for the
+             lookup in dst only; they are not src_cc coordinates)
+    """
+    cc = np.asarray(cc, dtype=np.float64).reshape(-1, 3)
+    offsets = offset_map["offsets"]
+
+    # fractional tile index of every cell (the last tile on an axis may be partial)
+    grid = np.stack([np.interp(cc[:, k], centres, np.arange(len(centres)))
+                     for k, centres in enumerate([offset_map["centres_z"],
+                                                  offset_map["centres_y"],
+                                                  offset_map["centres_x"]])])
+
+    disp = np.stack([map_coordinates(offsets[..., k].astype(np.float64), grid,
+                                     order=1, mode='nearest')
+                     for k in range(3)], axis=1)
+
+    return cc + disp
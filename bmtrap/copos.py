@@ -0,0 +1,331 @@
+"""copos.py: in-memory co-positive cell detection"""
+__author__      = "Minyoung Kim"
+__license__ = "MIT"
+__maintainer__ = "Minyoung Kim"
+__email__ = "minykim@mit.edu"
+
+import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+from bmtrap.util import dump2json, read_padded, bucket_by_block, bounded_map, nearest_voxel
+
+
+COPOS_DTYPE = np.dtype([("z", np.float64),
+                        ("y", np.float64),
+                        ("x", np.float64),
+                        ("prob", np.float32),
+                        ("copos", np.bool_)])
+
+
+def _default_block_size(vol):
+    """read block for probability lookup: the volume chunk if there is one"""
+    chunks = getattr(vol, "chunks", None)
+    if chunks is None:
+        return (16, 1024, 1024)
+    return tuple(int(c) for c in chunks[:3])
+
+
+def as_coords(cc):
+    """Nx3 float64 coordinates from any array-like (including an empty list)"""
+    return np.asarray(cc, dtype=np.float64).reshape(-1, 3)
+
+
+def _neighbours(pts, shape, mode="nearest"):
+    """voxels (and weights) needed to sample float coordinates
+    :param pts: Mx3 float coordinates (z, y, x)
+    :param shape: (z, y, x) shape of the volume; neighbours are clamped to it
+    :param mode: "nearest" or "linear" (trilinear)
+    :return: (list of Mx3 integer coordinates, list of M weights)
+    """
+    if mode == "nearest":
+        return [nearest_voxel(pts)], [1.0]
+
+    if mode == "linear":
+        shape = np.asarray(shape)
+        i0 = np.floor(pts).astype(np.int64)
+        w1 = pts - i0
+        nbrs, weights = [], []
+        for d in itertools.product((0, 1), repeat=3):
+            d = np.asarray(d)
+            nbrs.append(np.clip(i0 + d, 0, shape - 1))
+            weights.append(np.prod(np.where(d, w1, 1 - w1), axis=1))
+        return nbrs, weights
+
+    raise ValueError("Unknown sampling mode: %s" % mode)
+
+
+def sample_probs_multi(cc, prob_maps, block_size=None, n_workers=1,
+                       mode="nearest", radius=(1, 1, 1)):
+    """sample several probability maps at cell coordinates in one pass
+
+    Cells are bucketed once by block; each block reads only the bounding box
+    of the voxels it needs from every map, so memory is bounded by the block
+    size. Float coordinates are supported by every mode. Cells outside the
+    volume get NaN.
+
+    :param cc: Nx3 cell coordinates (z, y, x), integer or float
+    :param prob_maps: list of 3D probability maps of the same shape
+    :param block_size: (z, y, x) size of a read block (default: chunks of the first map)
+    :param n_workers: number of reader threads
+    :param mode: "nearest", "linear" (trilinear) or "max" (max in a neighbourhood)
+    :param radius: (z, y, x) neighbourhood radius for mode="max"
+    :return: N x len(prob_maps) probabilities (float32)
+    """
+    if mode not in ("nearest", "linear", "max"):
+        raise ValueError("Unknown sampling mode: %s" % mode)
+
+    cc = as_coords(cc)
+    shape = np.asarray(prob_maps[0].shape[:3])
+    radius = np.asarray(radius, dtype=np.int64)
+    if block_size is None:
+        block_size = _default_block_size(prob_maps[0])
+
+    res = np.full((len(cc), len(prob_maps)), np.nan, dtype=np.float32)
+    centres = nearest_voxel(cc)
+    inside = np.all((centres >= 0) & (centres < shape), axis=1)
+    sel = np.flatnonzero(inside)
+    order, bounds = bucket_by_block(centres[sel], block_size)
+    order = sel[order]
+
+    n_offsets = int(np.prod(2 * radius + 1))
+
+    def work_max(idx):
+        c0 = centres[idx]
+        lo = np.maximum(c0.min(axis=0) - radius, 0)
+        hi = np.minimum(c0.max(axis=0) + radius + 1, shape)
+        vals = np.empty((len(idx), len(prob_maps)), dtype=np.float32)
+        # filter the whole region when cells are dense, otherwise gather
+        # each offset and keep a running maximum
+        dense = len(idx) * n_offsets > np.prod(hi - lo)
+        for m, probs in enumerate(prob_maps):
+            region = read_padded(probs, lo, hi)
+            if dense:
+                # edges replicate = neighbourhood clamped to the volume
+                region = maximum_filter(region, size=2 * radius + 1, mode='nearest')
+                rel = c0 - lo
+                vals[:, m] = region[rel[:, 0], rel[:, 1], rel[:, 2]]
+                continue
+            vals[:, m] = -np.inf
+            for d in itertools.product(*[range(-r, r + 1) for r in radius]):
+                rel = np.clip(c0 + np.asarray(d), lo, hi - 1) - lo
+                np.maximum(vals[:, m], region[rel[:, 0], rel[:, 1], rel[:, 2]],
+                           out=vals[:, m])
+        return vals
+
+    def work_interp(idx):
+        nbrs, weights = _neighbours(cc[idx], shape, mode)
+        lo = np.min([n.min(axis=0) for n in nbrs], axis=0)
+        hi = np.max([n.max(axis=0) for n in nbrs], axis=0) + 1
+        vals = np.zeros((len(idx), len(prob_maps)), dtype=np.float32)
+        for m, probs in enumerate(prob_maps):
+            region = read_padded(probs, lo, hi)
+            for n, w in zip(nbrs, weights):
+                r = n - lo
+                vals[:, m] += w * region[r[:, 0], r[:, 1], r[:, 2]]
+        return vals
+
+    def work(b):
+        idx = order[bounds[b]:bounds[b+1]]
+        return idx, work_max(idx) if mode == "max" else work_interp(idx)
+
+    with ThreadPoolExecutor(n_workers) as ex:
+        for idx, vals in bounded_map(ex, work, range(len(bounds) - 1), 4 * n_workers):
+            res[idx] = vals
+
+    return res
+
+
+def sample_probs(cc, probs, block_size=None, n_workers=1, mode="nearest", radius=(1, 1, 1)):
+    """sample a probability map at cell coordinates (see sample_probs_multi())
+    :return: N probabilities (float32)
+    """
+    return sample_probs_multi(cc, [probs], block_size, n_workers, mode, radius)[:, 0]
+
+
+def find_copos(src_cc, dst_probs, threshold=0.4, block_size=None, n_workers=1,
+               mode="nearest", radius=(1, 1, 1), lookup_cc=None, save_path=None):
+    """find co-positive cells without going through the filesystem
+
+    :param src_cc: Nx3 source cell coordinates (z, y, x)
+    :param dst_probs: 3D destination probability map (numpy, zarr or array-like)
+    :param threshold: a cell is co-positive if its probability > threshold
+    :param block_size: (z, y, x) size of a read block (default: dst_probs chunks)
+    :param n_workers: number of reader threads
+    :param mode: sampling of float coordinates: "nearest", "linear" or "max"
+    :param radius: (z, y, x) neighbourhood radius for mode="max"
+    :param lookup_cc: Nx3 coordinates used for the lookup in dst_probs instead of src_cc
+                      (e.g. misalignment-corrected by align.apply_offsets());
+                      the result keeps src_cc
+    :param save_path: if given, save co-positive cells as in coReg.find_coPos()
+    :return: structured array (COPOS_DTYPE), one row per source cell
+    """
+    src_cc = as_coords(src_cc)
+    result = np.zeros(len(src_cc), dtype=COPOS_DTYPE)
+    result["z"], result["y"], result["x"] = src_cc[:, 0], src_cc[:, 1], src_cc[:, 2]
+    lookup_cc = src_cc if lookup_cc is None else as_coords(lookup_cc)
+    result["prob"] = sample_probs(lookup_cc, dst_probs, block_size, n_workers, mode, radius)
+    result["copos"] = result["prob"] > threshold
+
+    if save_path is not None:
+        save_copos(result, save_path, threshold)
+
+    return result
+
+
+def _combination(result, expr, channels):
+    """evaluate a boolean combination of channel columns
+    :param expr: channel names joined by '&' (all) or '|' (any),
+                 '!' negates a channel, e.g. "cFos&!V5"
+    """
+    if '&' in expr and '|' in expr:
+        raise ValueError("Mixing '&' and '|' is not supported: %s" % expr)
+    op = np.logical_or if '|' in expr else np.logical_and
+
+    flags = []
+    for term in expr.replace('|', '&').split('&'):
+        term = term.strip()
+        neg = term.startswith('!')
+        name = term.lstrip('!').strip()
+        if name not in channels:
+            raise ValueError("Unknown channel '%s' in combination: %s" % (name, expr))
+        flags.append(~result[name] if neg else result[name])
+
+    return op.reduce(flags)
+
+
+def check_columns(channels, combine=()):
+    """raise ValueError if channel names / combinations don't give unique table columns
+    :param channels: channel names
+    :param combine: boolean combinations of channels
+    """
+    columns = ["z", "y", "x"]
+    for ch in channels:
+        if not ch:
+            raise ValueError("Channel names can't be empty")
+        columns += [ch + "_prob", ch]
+    columns += list(combine)
+
+    seen = set()
+    for col in columns:
+        if col in seen:
+            raise ValueError("Duplicated column '%s' in the co-positivity table "
+                             "(channels: %s, combinations: %s): channels and combinations "
+                             "must be unique and can't be z, y, x or <channel>_prob"
+                             % (col, list(channels), list(combine)))
+        seen.add(col)
+
+
+def copos_table_dtype(channels, combine=()):
+    """dtype of the per-cell table: z, y, x, then <ch>_prob and <ch> per channel,
+    then one boolean column per combination"""
+    check_columns(channels, combine)
+    fields = [("z", np.float64), ("y", np.float64), ("x", np.float64)]
+    for ch in channels:
+        fields += [(ch + "_prob", np.float32), (ch, np.bool_)]
+    fields += [(expr, np.bool_) for expr in combine]
+    return np.dtype(fields)
+
+
+def find_copos_multi(src_cc, dst_probs, thresholds, combine=(), block_size=None,
+                     n_workers=1, mode="nearest", radius=(1, 1, 1), lookup_cc=None,
+                     save_path=None):
+    """evaluate co-positivity against several probability maps in a single pass
+
+    :param src_cc: Nx3 source cell coordinates (z, y, x)
+    :param dst_probs: dict of channel name -> 3D probability map
+    :param thresholds: dict of channel name -> threshold, or a list in dst_probs order
+    :param combine: boolean combinations of channels to add as columns (e.g. "cFos&V5")
+    :param block_size: (z, y, x) size of a read block
+    :param n_workers: number of reader threads
+    :param mode: sampling of float coordinates: "nearest", "linear" or "max"
+    :param radius: (z, y, x) neighbourhood radius for mode="max"
+    :param lookup_cc: Nx3 coordinates used for the lookup instead of src_cc
+                      (the table keeps src_cc)
+    :param save_path: if given, save the table and the co-positive cells per column
+    :return: structured array (copos_table_dtype()), one row per source cell
+    """
+    channels = list(dst_probs.keys())
+    if isinstance(thresholds, dict):
+        missing = [ch for ch in channels if ch not in thresholds]
+        if missing:
+            raise ValueError("Missing thresholds for channels: %s" % missing)
+    else:
+        thresholds = list(thresholds)
+        if len(thresholds) != len(channels):
+            raise ValueError("Number of thresholds (%d) doesn't match number of probability maps (%d)"
+                             % (len(thresholds), len(channels)))
+        thresholds = dict(zip(channels, thresholds))
+
+    src_cc = as_coords(src_cc)
+    result = np.zeros(len(src_cc), dtype=copos_table_dtype(channels, combine))
+    result["z"], result["y"], result["x"] = src_cc[:, 0], src_cc[:, 1], src_cc[:, 2]
+
+    lookup_cc = src_cc if lookup_cc is None else as_coords(lookup_cc)
+    probs = sample_probs_multi(lookup_cc, [dst_probs[ch] for ch in channels],
+                               block_size, n_workers, mode, radius)
+    for m, ch in enumerate(channels):
+        result[ch + "_prob"] = probs[:, m]
+        result[ch] = probs[:, m] > thresholds[ch]
+    for expr in combine:
+        result[expr] = _combination(result, expr, channels)
+
+    if save_path is not None:
+        save_copos_table(result, save_path)
+        for ch in channels:
+            save_copos(result, save_path, thresholds[ch], column=ch,
+                       prefix="CoPosCC_%s" % ch)
+        for expr in combine:
+            name = expr.replace(' ', '').replace('&', '_and_') \
+                       .replace('|', '_or_').replace('!', 'not_')
+            save_copos(result, save_path, None, column=expr,
+                       prefix="CoPosCC_%s" % name)
+
+    return result
+
+
+def copos_coords(result, column="copos"):
+    """return Nx3 (z, y, x) coordinates of the rows flagged in `column`"""
+    rows = result[result[column]]
+    return np.stack([rows["z"], rows["y"], rows["x"]], axis=1)
+
+
+def save_copos(result, save_path, threshold, column="copos", prefix="CoPosCC_ccPos"):
+    """save co-positive cells into .npy and .json (zyx and xyz)
+    :param result: structured array returned by find_copos()
+    :param save_path: output directory
+    :param threshold: threshold used (part of the file names, skipped if None)
+    :param column: boolean column selecting the cells to save
+    :param prefix: file name prefix
+    """
+    stacked_npy = copos_coords(result, column)
+    name = os.path.join(save_path, prefix)
+    if threshold is not None:
+        name += "_thr_%.2f" % threshold
+    np.save(name + ".npy", stacked_npy)
+    dump2json(name + ".json", stacked_npy.tolist())
+    dump2json(name + "_xyz.json", stacked_npy[:, ::-1].tolist())
+
+
+def save_copos_table(result, save_path, prefix="CoPosCC_table"):
+    """save the per-cell table as a structured .npy and a .csv
+    :param result: structured array returned by find_copos_multi()
+    :param save_path: output directory
+    :param prefix: file name prefix
+    """
+    name = os.path.join(save_path, prefix)
+    np.save(name + ".npy", result)
+
+    fmt = []
+    for field in result.dtype.names:
+        if result.dtype[field].kind == 'b':
+            fmt.append("%d")
+        elif field.endswith("_prob"):
+            fmt.append("%.4f")
+        else:
+            fmt.append("%.3f")
+    np.savetxt(name + ".csv", result, fmt=fmt, delimiter=',',
+               header=','.join(result.dtype.names), comments='')
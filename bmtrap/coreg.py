@@ -12,25 +12,108 @@ import numpy as np
 
 from phathom import io as pio
 from bmtrap.preprocessing import BMPreprocessing as BMPrep
+from bmtrap import patches
+from bmtrap import copos
+from bmtrap import align
+from bmtrap.const import StainChannel
 from bmtrap.util import *
 
 
 class coReg(object):
-    def __init__(self, params):
+    def __init__(self, params=None):
         """init
-        :param params: BasicParams() object
+        :param params: BasicParams() object (OPTIONAL when data is given by set_data())
         """
         self.params = params
         self.bmPrep = BMPrep()
+        self.lookup_cc = None
 
 
     def load_data(self):
         """load zarr volumes, probability maps, and source cell coordinates"""
         self.src_vol = pio.zarr.open(self.params.src_zarrpath)
-        self.dst_probs = pio.zarr.open(self.params.dst_probpath)
+        self.dst_probs_all = {ch: pio.zarr.open(path) for ch, path
+                              in zip(self.params.channels, self.params.dst_probpaths)}
+        self.dst_probs = self.dst_probs_all[self.params.channels[0]]
         self.dst_vol = pio.zarr.open(self.params.dst_zarrpath)
         self.src_cc = np.load(self.params.src_cc)
-        
+        self.lookup_cc = None
+
+
+    def set_data(self, src_vol=None, dst_vol=None, dst_probs=None, src_cc=None):
+        """set volumes and cell coordinates from memory instead of load_data()
+        :param src_vol: source volume (numpy, zarr or array-like)
+        :param dst_vol: destination volume (numpy, zarr or array-like)
+        :param dst_probs: destination probability map (numpy, zarr or array-like),
+                          or a dict of channel name -> probability map
+                          (a single map is used as the cFos channel)
+        :param src_cc: Nx3 source cell coordinates
+        """
+        self.src_vol = src_vol
+        self.dst_vol = dst_vol
+        if isinstance(dst_probs, dict):
+            self.dst_probs_all = dst_probs
+            self.dst_probs = next(iter(dst_probs.values()))
+        else:
+            self.dst_probs_all = {StainChannel.CFOS: dst_probs}
+            self.dst_probs = dst_probs
+        self.src_cc = np.asarray(src_cc) if src_cc is not None else None
+        self.lookup_cc = None
+
+
+    def correct_offsets(self, offset_map):
+        """look up dst probabilities at src_cc shifted by a misalignment offset map;
+        src_cc (and the saved coordinates) stay in src space.
+        Used by copos() and copos_multi(); the legacy find_coPos() can't apply it
+        and raises once offsets are set.
+        :param offset_map: offset map from align.estimate_offsets() / align.load_offsets()
+        """
+        self.lookup_cc = align.apply_offsets(self.src_cc, offset_map)
+
+
+    def copos(self, threshold=None, n_workers=1, mode="nearest", radius=(1, 1, 1), save=False):
+        """find co-positive cells in memory (see copos.find_copos())
+        :param threshold: threshold for co-positivity (default: params.threshold)
+        :param n_workers: number of reader threads
+        :param mode: sampling of float coordinates: "nearest", "linear" or "max"
+        :param radius: (z, y, x) neighbourhood radius for mode="max"
+        :param save: save co-positive cells into params.save_path
+        """
+        if self.params is None and (threshold is None or save):
+            raise ValueError("threshold is required and save is not available "
+                             "when coReg is built without params")
+        if threshold is None:
+            threshold = self.params.threshold
+        save_path = self.params.save_path if save else None
+
+        return copos.find_copos(self.src_cc, self.dst_probs, threshold,
+                                n_workers=n_workers, mode=mode, radius=radius,
+                                lookup_cc=self.lookup_cc, save_path=save_path)
+
+
+    def copos_multi(self, thresholds=None, combine=(), n_workers=1, mode="nearest",
+                    radius=(1, 1, 1), save=False):
+        """evaluate co-positivity against all destination probability maps in one pass
+        (see copos.find_copos_multi())
+        :param thresholds: dict of channel -> threshold (default: params.thresholds)
+        :param combine: boolean combinations of channels (e.g. "cFos&V5")
+        :param n_workers: number of reader threads
+        :param mode: sampling of float coordinates: "nearest", "linear" or "max"
+        :param radius: (z, y, x) neighbourhood radius for mode="max"
+        :param save: save the table and co-positive cells into params.save_path
+        """
+        if self.params is None and (thresholds is None or save):
+            raise ValueError("thresholds are required and save is not available "
+                             "when coReg is built without params")
+        if thresholds is None:
+            thresholds = dict(zip(self.params.channels, self.params.thresholds))
+        save_path = self.params.save_path if save else None
+
+        return copos.find_copos_multi(self.src_cc, self.dst_probs_all, thresholds,
+                                      combine=combine, n_workers=n_workers,
+                                      mode=mode, radius=radius, lookup_cc=self.lookup_cc,
+                                      save_path=save_path)
+
 
     def get_pp(self, cc, a_slice, thr=0.4):
         """get points overlapping with high-probability area of dest probMap
@@ -78,6 +161,9 @@ class coReg(object):
         :param viz: plot intermittent results
         :param save: save list of co-positive cells into .npy and .json
         """
+        if self.lookup_cc is not None:
+            raise ValueError("find_coPos() doesn't apply misalignment offsets; "
+                             "use copos() or copos_multi() after correct_offsets()")
 
         def style_ax(ax, title, title_loc='center'):
             ax.set_title(title, color='w', loc=title_loc)
@@ -180,6 +266,23 @@ class coReg(object):
         return src_subvol, dst_subvol, dst_subprobs
 
 
+    def export_patches(self, out_path, cc=None, patch_size=(16, 32, 32), n_workers=4):
+        """export src, dst and dst-probMap patches centred on cells
+        (e.g. for training/inference of a false-positive classifier)
+
+        :param out_path: output path (.npy or zarr)
+        :param cc: cell coordinates (default: self.src_cc)
+        :param patch_size: (z, y, x) size of a patch
+        :param n_workers: number of reader threads
+        """
+        if cc is None:
+            cc = self.src_cc
+
+        return patches.export_patches(cc, [self.src_vol, self.dst_vol, self.dst_probs],
+                                      out_path, patch_size=patch_size,
+                                      n_workers=n_workers)
+
+
     def get_cc_in_region(self, cc_list, xr, yr, zr, relative=False):
         """return cells within the ROI
         
@@ -0,0 +1,170 @@
+"""dedup.py: merge duplicated cell detections (e.g. across chunk borders)"""
+__author__      = "Minyoung Kim"
+__license__ = "MIT"
+__maintainer__ = "Minyoung Kim"
+__email__ = "minykim@mit.edu"
+
+import itertools
+
+import numpy as np
+
+from bmtrap.util import nearest_voxel
+
+
+def _close_pairs(s, radius_sq=1.0, batch_size=1000000):
+    """find all pairs of points within a radius using a uniform grid hash of cell size 1
+    :param s: Nx3 float coordinates (already divided by the radius)
+    :param radius_sq: squared radius in scaled units (<= 1)
+    :param batch_size: number of points processed at once (bounds memory)
+    :return: (i, j) arrays of indices into s
+    """
+    n = len(s)
+    g = np.floor(s).astype(np.int64)
+    g -= g.min(axis=0) - 1              # keep one empty cell around the grid
+    dims = g.max(axis=0) + 2
+    key = np.ravel_multi_index(g.T, dims)
+
+    order = np.argsort(key, kind="stable")
+    skey = key[order]
+    ss = s[order]
+
+    # occupied grid cells: key, first point and number of points
+    first = np.concatenate([[0], np.flatnonzero(skey[1:] != skey[:-1]) + 1])
+    ukey = skey[first]
+    ucount = np.diff(np.append(first, n))
+    cell = np.repeat(np.arange(len(ukey)), ucount)
+
+    # own cell + the 13 neighbouring cells with a larger key
+    strides = np.array([dims[1] * dims[2], dims[2], 1])
+    offsets = [0] + sorted(int(np.dot(o, strides))
+                           for o in itertools.product((-1, 0, 1), repeat=3)
+                           if np.dot(o, strides) > 0)
+
+    # neighbouring cell of every occupied cell (-1 if empty)
+    idx_dtype = np.int32 if len(ukey) < 2**31 else np.int64
+    nbrs = []
+    for dk in offsets[1:]:
+        pos = np.minimum(np.searchsorted(ukey, ukey + dk), len(ukey) - 1)
+        nbrs.append(np.where(ukey[pos] == ukey + dk, pos, -1).astype(idx_dtype))
+
+    pi, pj = [], []
+    for b0 in range(0, n, batch_size):
+        ib = np.arange(b0, min(b0 + batch_size, n))
+        cb = cell[ib]
+        for k in range(len(offsets)):
+            if k == 0:
+                start = ib + 1
+                cnt = first[cb] + ucount[cb] - start
+            else:
+                nb = nbrs[k - 1][cb]
+                start = first[nb]
+                cnt = np.where(nb >= 0, ucount[nb], 0)
+            total = cnt.sum()
+            if total == 0:
+                continue
+            i = np.repeat(ib, cnt)
+            j = np.repeat(start - np.cumsum(cnt) + cnt, cnt) + np.arange(total)
+            d = ss[i] - ss[j]
+            close = np.einsum("ij,ij->i", d, d) <= radius_sq
+            pi.append(order[i[close]])
+            pj.append(order[j[close]])
+
+    if not pi:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pi), np.concatenate(pj)
+
+
+def _greedy_labels(i, j, n):
+    """assign every point to a representative within the radius (NMS-style)
+
+    Equivalent to visiting points in input order, where a point that is not
+    yet assigned becomes a representative and takes all its unassigned
+    neighbours, so groups never chain beyond one radius from their
+    representative. Decided in vectorized rounds: a point becomes a member
+    once a lower-index neighbour is a representative, and a representative
+    once all its lower-index neighbours are members. The number of rounds
+    grows with the length of chains of close points, not with their number.
+
+    :param i, j: pairs of points within the radius
+    :param n: number of points
+    :return: representative index of every point
+    """
+    UNDECIDED, REP, MEMBER = 0, 1, 2
+    lo, hi = np.minimum(i, j), np.maximum(i, j)
+    state = np.full(n, REP, dtype=np.int8)
+    state[hi] = UNDECIDED                          # points with a lower-index neighbour
+
+    # only the higher end of an edge can be undecided; flags are cleared after each round
+    has_rep = np.zeros(n, dtype=np.bool_)
+    blocked = np.zeros(n, dtype=np.bool_)
+    e_lo, e_hi = lo, hi
+    while True:
+        keep = state[e_hi] == UNDECIDED
+        e_lo, e_hi = e_lo[keep], e_hi[keep]
+        if len(e_hi) == 0:
+            break
+        s_lo = state[e_lo]
+        has_rep[e_hi[s_lo == REP]] = True
+        blocked[e_hi[s_lo == UNDECIDED]] = True
+
+        member = has_rep[e_hi]
+        rep = ~member & ~blocked[e_hi]
+        has_rep[e_hi] = False
+        blocked[e_hi] = False
+        state[e_hi[member]] = MEMBER
+        state[e_hi[rep]] = REP
+
+    # members belong to their lowest-index representative neighbour
+    labels = np.arange(n)
+    claim = (state[lo] == REP) & (state[hi] == MEMBER)
+    c_lo, c_hi = lo[claim], hi[claim]
+    order = np.lexsort((c_lo, c_hi))
+    c_lo, c_hi = c_lo[order], c_hi[order]
+    first = np.ones(len(c_hi), dtype=np.bool_)
+    first[1:] = c_hi[1:] != c_hi[:-1]
+    labels[c_hi[first]] = c_lo[first]
+
+    return labels
+
+
+def dedup_cells(cc, radius=(2, 4, 4), batch_size=1000000):
+    """merge cell detections within an anisotropic radius
+
+    Points are hashed into a uniform grid whose cells are one radius wide, so
+    only the neighbouring grid cells need to be compared, and groups are formed
+    in vectorized rounds (near-linear time).
+    Detections are then merged greedily in input order: each group consists of
+    a representative and its neighbours within the radius, so groups never
+    extend further than one radius from their representative. A group is
+    replaced by its centroid, listed in the input order of its representative.
+
+    :param cc: Nx3 cell coordinates (z, y, x)
+    :param radius: (z, y, x) merge radius in voxels (all > 0)
+    :param batch_size: number of points compared at once (bounds memory)
+    :return: (dedup_cc, n_merged)
+    """
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), 3)
+    if np.any(radius <= 0):
+        raise ValueError("Merge radius must be positive: %s" % (radius.tolist(),))
+
+    cc = np.asarray(cc)
+    n = len(cc)
+    if n == 0:
+        return cc.copy(), 0
+
+    i, j = _close_pairs(cc / radius, 1.0, batch_size)
+    if len(i) == 0:
+        return cc.copy(), 0
+
+    # representatives are the first member of their group, so np.unique keeps input order
+    _, labels = np.unique(_greedy_labels(i, j, n), return_inverse=True)
+    labels = labels.ravel()
+
+    n_out = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_out)
+    merged = np.stack([np.bincount(labels, cc[:, k], minlength=n_out) / counts
+                       for k in range(3)], axis=1)
+    if np.issubdtype(cc.dtype, np.integer):
+        merged = nearest_voxel(merged)
+
+    return merged.astype(cc.dtype), int(n - n_out)
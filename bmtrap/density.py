@@ -0,0 +1,116 @@
+"""density.py: voxelwise cell density maps"""
+__author__      = "Minyoung Kim"
+__license__ = "MIT"
+__maintainer__ = "Minyoung Kim"
+__email__ = "minykim@mit.edu"
+
+import numpy as np
+import tifffile
+import zarr
+from scipy.ndimage import gaussian_filter1d
+from tqdm import tqdm
+
+
+def density_shape(vol_shape, voxel_size, out_voxel_size=25.0):
+    """shape of the density grid covering a volume
+    :param vol_shape: (z, y, x) shape of the full-resolution volume
+    :param voxel_size: (z, y, x) voxel size of the volume (um)
+    :param out_voxel_size: voxel size of the density grid (um), scalar or (z, y, x)
+    """
+    extent = np.asarray(vol_shape, dtype=np.float64) * np.asarray(voxel_size, dtype=np.float64)
+    return tuple(int(s) for s in np.ceil(extent / np.broadcast_to(out_voxel_size, 3)))
+
+
+def bin_points(points, vol_shape, voxel_size, out_voxel_size=25.0, batch_size=1000000):
+    """count points per voxel of a downsampled grid, streaming points in batches
+
+    :param points: Nx3 (z, y, x) coordinates in full-resolution voxels;
+                   can be a memory-mapped array (np.load(..., mmap_mode='r'))
+    :param vol_shape: (z, y, x) shape of the full-resolution volume
+    :param voxel_size: (z, y, x) voxel size of the volume (um)
+    :param out_voxel_size: voxel size of the density grid (um), scalar or (z, y, x)
+    :param batch_size: number of points binned at once
+    :return: float32 grid of counts
+    """
+    shape = density_shape(vol_shape, voxel_size, out_voxel_size)
+    factor = np.asarray(voxel_size, dtype=np.float64) / np.broadcast_to(out_voxel_size, 3)
+    size = int(np.prod(shape))
+    counts = np.zeros(size, dtype=np.int64)
+
+    for b0 in tqdm(range(0, len(points), batch_size), "Binning"):
+        crd = np.floor(np.asarray(points[b0:b0+batch_size], dtype=np.float64) * factor)
+        crd = crd.astype(np.int64)
+        inside = np.all((crd >= 0) & (crd < np.asarray(shape)), axis=1)
+        if not np.any(inside):
+            continue
+        idx = np.ravel_multi_index(crd[inside].T, shape)
+
+        # bincount over the covered range only, unless it is much larger than the batch
+        lo, hi = idx.min(), idx.max() + 1
+        if hi - lo <= 4 * len(idx):
+            counts[lo:hi] += np.bincount(idx - lo, minlength=hi - lo)
+        else:
+            u, c = np.unique(idx, return_counts=True)
+            counts[u] += c
+
+    return counts.reshape(shape).astype(np.float32)
+
+
+def smooth(grid, sigma, block=64):
+    """separable Gaussian smoothing, in place, one slab at a time
+    :param grid: 3D float array
+    :param sigma: Gaussian sigma (voxels), scalar or (z, y, x)
+    :param block: slab thickness (voxels) along the axis not being filtered
+    """
+    sigma = np.broadcast_to(sigma, 3)
+    for axis in range(3):
+        if sigma[axis] <= 0:
+            continue
+        slab_axis = 1 if axis == 0 else 0
+        for s0 in range(0, grid.shape[slab_axis], block):
+            sl = [slice(None)] * 3
+            sl[slab_axis] = slice(s0, s0 + block)
+            sl = tuple(sl)
+            grid[sl] = gaussian_filter1d(grid[sl], sigma[axis], axis=axis, mode='constant')
+
+    return grid
+
+
+def save_density(grid, out_path, chunks=(64, 64, 64)):
+    """save a density grid as zarr, TIFF or .npy (by extension)"""
+    if out_path.endswith((".tif", ".tiff")):
+        tifffile.imwrite(out_path, grid)
+    elif out_path.endswith(".npy"):
+        np.save(out_path, grid)
+    else:
+        z = zarr.open(out_path, mode='w', shape=grid.shape, dtype=grid.dtype,
+                      chunks=tuple(min(c, s) for c, s in zip(chunks, grid.shape)))
+        z[:] = grid
+
+
+def density_map(points, vol_shape, voxel_size, out_voxel_size=25.0, sigma=0,
+                per_mm3=False, batch_size=1000000, out_path=None):
+    """voxelwise density map of cell coordinates (e.g. src_cc or CoPosCC_ccPos_thr_*.npy)
+
+    :param points: Nx3 (z, y, x) coordinates in full-resolution voxels
+    :param vol_shape: (z, y, x) shape of the full-resolution volume
+    :param voxel_size: (z, y, x) voxel size of the volume (um)
+    :param out_voxel_size: voxel size of the density grid (um), scalar or (z, y, x)
+    :param sigma: Gaussian smoothing sigma (um), 0 for none
+    :param per_mm3: return cells/mm^3 instead of cells/voxel
+    :param batch_size: number of points binned at once
+    :param out_path: save to .zarr, .tif or .npy if given
+    """
+    out_voxel_size = np.broadcast_to(np.asarray(out_voxel_size, dtype=np.float64), 3)
+    grid = bin_points(points, vol_shape, voxel_size, out_voxel_size, batch_size)
+
+    if np.any(np.asarray(sigma) > 0):
+        smooth(grid, np.asarray(sigma, dtype=np.float64) / out_voxel_size)
+
+    if per_mm3:
+        grid *= 1e9 / np.prod(out_voxel_size)
+
+    if out_path is not None:
+        save_density(grid, out_path)
+
+    return grid
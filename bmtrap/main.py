@@ -11,9 +11,13 @@ warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 import numpy as np
 import argparse
+from phathom import io as pio
 
-from bmtrap.params import BaseParams
+from bmtrap.params import BaseParams, DensityParams, AlignParams
 from bmtrap.coreg import coReg
+from bmtrap.dedup import dedup_cells
+from bmtrap.density import density_map
+from bmtrap import align
 
 
 def main():
@@ -29,8 +33,59 @@ def main():
     print("\tdst probMap shape: ", cr.dst_probs.shape)
     print("\tlen(src_cc): ", len(cr.src_cc))
 
-    print("finding co-positive cells..")
-    cp_ccl = cr.find_coPos(viz=False, save=True)
+    if p.dedup_radius is not None:
+        print("merging duplicated cells..")
+        cr.src_cc, n_merged = dedup_cells(cr.src_cc, p.dedup_radius)
+        print("\tmerged: ", n_merged, "len(src_cc): ", len(cr.src_cc))
+
+    if p.offset_map is not None:
+        print("correcting src/dst misalignment..")
+        cr.correct_offsets(align.load_offsets(p.offset_map))
+
+    # find_coPos() only handles a single map sampled at uncorrected integer coordinates
+    single = len(p.dst_probpaths) == 1 and not p.combine
+    if single and p.sampling == 'nearest' and p.offset_map is None \
+            and np.issubdtype(cr.src_cc.dtype, np.integer):
+        print("finding co-positive cells..")
+        cp_ccl = cr.find_coPos(viz=False, save=True)
+    elif single:
+        print("finding co-positive cells ({} sampling)..".format(p.sampling))
+        result = cr.copos(n_workers=p.n_workers, mode=p.sampling,
+                          radius=p.sampling_radius, save=True)
+        print("\tco-positive: ", result["copos"].sum())
+    else:
+        print("finding co-positive cells for {}..".format(", ".join(p.channels)))
+        table = cr.copos_multi(combine=p.combine, n_workers=p.n_workers,
+                               mode=p.sampling, radius=p.sampling_radius, save=True)
+        for col in p.channels + p.combine:
+            print("\t{}: {}".format(col, table[col].sum()))
+
+
+def density_main():
+    p = DensityParams()
+    p.build(sys.argv, "TRAP Density Parser")
+
+    points = np.load(p.points, mmap_mode='r')
+    print("computing density map of {} points..".format(len(points)))
+    grid = density_map(points, p.shape, p.voxel_size, p.out_voxel_size,
+                       sigma=p.sigma, per_mm3=p.per_mm3,
+                       batch_size=p.batch_size, out_path=p.output)
+    print("\tdensity map shape: ", grid.shape, "saved to ", p.output)
+
+
+def align_main():
+    p = AlignParams()
+    p.build(sys.argv, "TRAP Align Parser")
+
+    src_vol = pio.zarr.open(p.src_zarrpath)
+    dst_vol = pio.zarr.open(p.dst_zarrpath)
+    print("estimating tile offsets..")
+    offset_map = align.estimate_offsets(src_vol, dst_vol, p.tile_size, p.downsample,
+                                        n_workers=p.n_workers, min_quality=p.min_quality,
+                                        out_path=p.output)
+    valid = offset_map["valid"]
+    print("\tvalid tiles: {}/{}".format(valid.sum(), valid.size))
+    print("\tmedian offset (ZYX): ", np.median(offset_map["offsets"].reshape(-1, 3), axis=0))
 
 
 if __name__=="__main__":
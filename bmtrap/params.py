@@ -6,6 +6,8 @@ __email__ = "minykim@mit.edu"
 
 import argparse
 import bmtrap.util as tUtil
+from bmtrap.const import StainChannel
+from bmtrap.copos import check_columns
 
 class BaseParams(object):
     """BaseParams Class"""
@@ -34,12 +36,28 @@ class BaseParams(object):
                             help='Path to destination TIFF')
         parser.add_argument('-dz', '--dst_zarrpath',
                             help='Path to destination ZARR', required=True)
-        parser.add_argument('-dp', '--dst_probpath',
-                            help="Path to destination Probability Map", required=True)
+        parser.add_argument('-dp', '--dst_probpath', nargs='+',
+                            help="Path(s) to destination Probability Map(s)", required=True)
         parser.add_argument('-sp', '--save_path',
                             help="Path to save output files", required=True)
-        parser.add_argument('-thr', '--threshold', type=float, default=0.4,
-                            help="Threshold for co-positivity", required=True)
+        parser.add_argument('-thr', '--threshold', type=float, nargs='+', default=[0.4],
+                            help="Threshold(s) for co-positivity (one, or one per probability map)",
+                            required=True)
+        parser.add_argument('-ch', '--channels', nargs='+', default=None,
+                            help="Channel names of the probability maps (e.g. cFos V5)")
+        parser.add_argument('-cb', '--combine', nargs='+', default=[],
+                            help="Boolean combinations of channels (e.g. 'cFos&V5' 'cFos|V5' 'cFos&!V5')")
+        parser.add_argument('-nw', '--n_workers', type=int, default=1,
+                            help="Number of reader threads")
+        parser.add_argument('-sm', '--sampling', default='nearest',
+                            choices=['nearest', 'linear', 'max'],
+                            help="Probability sampling at (float) cell coordinates")
+        parser.add_argument('-sr', '--sampling_radius', type=int, nargs=3, default=[1, 1, 1],
+                            help="(Z, Y, X) neighbourhood radius for '--sampling max'")
+        parser.add_argument('-om', '--offset_map', default=None,
+                            help="Offset map (.npz from bmtrap-align) applied to source cells")
+        parser.add_argument('-dr', '--dedup_radius', type=float, nargs=3, default=None,
+                            help="Merge source cells within (Z, Y, X) radius before co-positivity")
         parser.add_argument('-dbg', '--debug', action='store_true', default=False)
 
         return parser
@@ -70,8 +88,28 @@ class BaseParams(object):
 
 
     def postproc_args(self):
-        # Nothing to do for base class
-        pass
+        """keep a single probability map / threshold as dst_probpath / threshold,
+           and the lists of all of them as dst_probpaths / thresholds"""
+        self.dst_probpaths = self.dst_probpath
+        if len(self.threshold) == 1:
+            self.threshold = self.threshold * len(self.dst_probpaths)
+        if len(self.threshold) != len(self.dst_probpaths):
+            raise ValueError("Number of thresholds (%d) doesn't match number of probability maps (%d)"
+                             % (len(self.threshold), len(self.dst_probpaths)))
+        self.thresholds = self.threshold
+
+        if self.channels is None:
+            if len(self.dst_probpaths) == 1:
+                self.channels = [StainChannel.CFOS]
+            else:
+                self.channels = ["ch%d" % i for i in range(len(self.dst_probpaths))]
+        if len(self.channels) != len(self.dst_probpaths):
+            raise ValueError("Number of channels (%d) doesn't match number of probability maps (%d)"
+                             % (len(self.channels), len(self.dst_probpaths)))
+        check_columns(self.channels, self.combine)
+
+        self.dst_probpath = self.dst_probpaths[0]
+        self.threshold = self.thresholds[0]
 
 
     def print_params(self, returnOnly=False):
@@ -79,3 +117,71 @@ class BaseParams(object):
         return tUtil.print_class_params(self.__class__.__name__, vars(self), returnOnly=returnOnly)
 
 
+class DensityParams(BaseParams):
+    """DensityParams Class"""
+
+    def _parser(self, desc=None):
+        """add list of arguments to ArgumentParser
+
+        Params
+        ---------
+        desc: description of Params set
+        """
+        parser = argparse.ArgumentParser(description=desc)
+        parser.add_argument('-pt', '--points',
+                            help="NUMPY file containing cell coordinates (ZYX)", required=True)
+        parser.add_argument('-sh', '--shape', type=int, nargs=3,
+                            help="(Z, Y, X) shape of the full-resolution volume", required=True)
+        parser.add_argument('-vs', '--voxel_size', type=float, nargs=3,
+                            help="(Z, Y, X) voxel size of the volume in um", required=True)
+        parser.add_argument('-ovs', '--out_voxel_size', type=float, default=25.0,
+                            help="Voxel size of the density map in um")
+        parser.add_argument('-sg', '--sigma', type=float, default=0.0,
+                            help="Gaussian smoothing sigma in um (0: no smoothing)")
+        parser.add_argument('-mm3', '--per_mm3', action='store_true', default=False,
+                            help="Density in cells/mm^3 instead of cells/voxel")
+        parser.add_argument('-bs', '--batch_size', type=int, default=1000000,
+                            help="Number of points binned at once")
+        parser.add_argument('-o', '--output',
+                            help="Output path (.zarr, .tif or .npy)", required=True)
+        parser.add_argument('-dbg', '--debug', action='store_true', default=False)
+
+        return parser
+
+    def postproc_args(self):
+        # Nothing to do for density params
+        pass
+
+
+class AlignParams(BaseParams):
+    """AlignParams Class"""
+
+    def _parser(self, desc=None):
+        """add list of arguments to ArgumentParser
+
+        Params
+        ---------
+        desc: description of Params set
+        """
+        parser = argparse.ArgumentParser(description=desc)
+        parser.add_argument('-sz', '--src_zarrpath',
+                            help="Path to source ZARR", required=True)
+        parser.add_argument('-dz', '--dst_zarrpath',
+                            help='Path to destination ZARR', required=True)
+        parser.add_argument('-ts', '--tile_size', type=int, nargs=3, default=[64, 1024, 1024],
+                            help="(Z, Y, X) tile size in full-resolution voxels")
+        parser.add_argument('-ds', '--downsample', type=int, nargs=3, default=[1, 4, 4],
+                            help="(Z, Y, X) downsampling factor of the tiles")
+        parser.add_argument('-mq', '--min_quality', type=float, default=0.05,
+                            help="Minimum correlation peak for a tile offset to be trusted")
+        parser.add_argument('-nw', '--n_workers', type=int, default=4,
+                            help="Number of worker threads")
+        parser.add_argument('-o', '--output',
+                            help="Output offset map (.npz)", required=True)
+        parser.add_argument('-dbg', '--debug', action='store_true', default=False)
+
+        return parser
+
+    def postproc_args(self):
+        # Nothing to do for align params
+        pass
@@ -0,0 +1,121 @@
+"""patches.py: cell-centred patch export for model training and inference"""
+__author__      = "Minyoung Kim"
+__license__ = "MIT"
+__maintainer__ = "Minyoung Kim"
+__email__ = "minykim@mit.edu"
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import zarr
+from tqdm import tqdm
+
+from bmtrap.util import read_padded, bucket_by_block, bounded_map, nearest_voxel
+
+
+def _default_block_size(vol, patch_size):
+    """block used for coalescing reads: the volume chunk, but never thinner
+    than a few patches so that margins don't dominate the reads"""
+    chunks = getattr(vol, "chunks", None)
+    if chunks is None:
+        chunks = (64, 256, 256)
+    return tuple(max(int(c), 4 * int(p)) for c, p in zip(chunks[:3], patch_size))
+
+
+def _open_output(out_path, shape, dtype, chunk_n):
+    """create the output patch stack (.npy memmap or zarr group)
+    :return: (patches, root) where root is the zarr group or None
+    """
+    if out_path.endswith(".npy"):
+        patches = np.lib.format.open_memmap(out_path, mode='w+',
+                                            dtype=dtype, shape=shape)
+        return patches, None
+
+    root = zarr.open_group(out_path, mode='w')
+    patches = root.zeros("patches", shape=shape, dtype=dtype,
+                         chunks=(chunk_n,) + tuple(shape[1:]))
+    return patches, root
+
+
+def _extract_block(vols, cc, patch_size, pad_value, dtype):
+    """read one coalesced region per volume and crop all patches of a block
+    :param vols: list of 3D volumes
+    :param cc: Mx3 integer coordinates of the cells in the block
+    :return: M x len(vols) x pz x py x px array
+    """
+    size = np.asarray(patch_size)
+    half = size // 2
+    lo = cc.min(axis=0) - half
+    hi = cc.max(axis=0) - half + size
+    offs = cc - half - lo
+
+    out = np.empty((len(cc), len(vols)) + tuple(patch_size), dtype=dtype)
+    for vi, vol in enumerate(vols):
+        region = read_padded(vol, lo, hi, pad_value)
+        for k, (z, y, x) in enumerate(offs):
+            out[k, vi] = region[z:z+size[0], y:y+size[1], x:x+size[2]]
+
+    return out
+
+
+def export_patches(cc, vols, out_path, patch_size=(16, 32, 32), block_size=None,
+                   n_workers=4, pad_value=0, dtype=None, chunk_n=64):
+    """export fixed-size 3D patches centred on cells into one patch stack
+
+    Cells are bucketed by block so that every block reads a single region from
+    each volume; blocks are read by a pool of workers and written sequentially.
+    Patches are stored in block order: `index` holds, for each patch, the row
+    of `cc` it was cropped around.
+
+    :param cc: Nx3 cell coordinates (z, y, x); float coordinates are rounded
+    :param vols: list of 3D volumes (e.g. [src_vol, dst_vol, dst_probs])
+    :param out_path: output path, `.npy` (memmap) or zarr group otherwise
+    :param patch_size: (z, y, x) size of a patch
+    :param block_size: (z, y, x) size of a read block (default: volume chunks)
+    :param n_workers: number of reader threads
+    :param pad_value: value for voxels outside the volume
+    :param dtype: output dtype (default: common type of all volumes)
+    :param chunk_n: number of patches per zarr chunk
+    :return: (patches, index)
+    """
+    cc = nearest_voxel(np.asarray(cc, dtype=np.float64).reshape(-1, 3))
+    if dtype is None:
+        dtype = np.result_type(*[vol.dtype for vol in vols])
+    if block_size is None:
+        block_size = _default_block_size(vols[0], patch_size)
+
+    order, bounds = bucket_by_block(cc, block_size)
+    shape = (len(cc), len(vols)) + tuple(patch_size)
+    patches, root = _open_output(out_path, shape, dtype, chunk_n)
+
+    def work(b):
+        idx = order[bounds[b]:bounds[b+1]]
+        return _extract_block(vols, cc[idx], patch_size, pad_value, dtype)
+
+    # buffer results so that zarr chunks are written once
+    buf, buf_start, pos = [], 0, 0
+    n_blocks = len(bounds) - 1
+    with ThreadPoolExecutor(n_workers) as ex:
+        for res in tqdm(bounded_map(ex, work, range(n_blocks), 4 * n_workers),
+                        "Patches", total=n_blocks):
+            buf.append(res)
+            pos += len(res)
+            if pos - buf_start >= chunk_n or pos == len(cc):
+                stop = pos if pos == len(cc) else pos - pos % chunk_n
+                data = np.concatenate(buf)
+                patches[buf_start:stop] = data[:stop - buf_start]
+                buf = [data[stop - buf_start:]]
+                buf_start = stop
+
+    # save the cell index and coordinates of each patch
+    if root is not None:
+        root.array("index", order, overwrite=True)
+        root.array("coords", cc[order], overwrite=True)
+    else:
+        patches.flush()
+        stem = os.path.splitext(out_path)[0]
+        np.save(stem + "_index.npy", order)
+        np.save(stem + "_coords.npy", cc[order])
+
+    return patches, order
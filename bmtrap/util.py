@@ -12,8 +12,11 @@ import os
 from os import system
 from os.path import *
 from datetime import datetime
+from itertools import islice
 import json
 
+import numpy as np
+
 def dump2json(fname, data):
     """dump data to json
     :param fname: JSON file name to save
@@ -100,3 +103,65 @@ class PRT(object):
 def get_current_time():
     """return current time"""
     return datetime.now().strftime('%Y-%m-%d_%H%M%S')
+
+
+def read_padded(vol, lo, hi, pad_value=0):
+    """read vol[lo:hi] (3D), padding the parts that fall outside the volume
+    :param vol: 3D array (numpy, zarr or array-like supporting slicing)
+    :param lo: (z, y, x) start of the region (can be negative)
+    :param hi: (z, y, x) end of the region (can exceed vol.shape)
+    :param pad_value: value used for out-of-volume voxels
+    """
+    shape = np.asarray(vol.shape[:3])
+    lo = np.asarray(lo, dtype=np.int64)
+    hi = np.asarray(hi, dtype=np.int64)
+    clo = np.clip(lo, 0, shape)
+    chi = np.maximum(np.clip(hi, 0, shape), clo)
+    region = np.asarray(vol[clo[0]:chi[0], clo[1]:chi[1], clo[2]:chi[2]])
+
+    if np.any(clo != lo) or np.any(chi != hi):
+        pad = [(int(a), int(b)) for a, b in zip(clo - lo, hi - chi)]
+        region = np.pad(region, pad, mode='constant', constant_values=pad_value)
+
+    return region
+
+
+def nearest_voxel(pts):
+    """nearest voxel of float coordinates (halves always round up, unlike np.round)"""
+    return np.floor(np.asarray(pts, dtype=np.float64) + 0.5).astype(np.int64)
+
+
+def bucket_by_block(cc, block_size):
+    """group coordinates by the (z, y, x) block they fall in
+    :param cc: Nx3 integer coordinates
+    :param block_size: (z, y, x) size of a block
+    :return: (order, bounds) where cc[order[bounds[i]:bounds[i+1]]] is the i-th block
+    """
+    cc = np.asarray(cc)
+    if len(cc) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+
+    blk = np.floor_divide(cc, np.asarray(block_size)).astype(np.int64)
+    order = np.lexsort((blk[:, 2], blk[:, 1], blk[:, 0]))
+    blk = blk[order]
+    change = np.flatnonzero(np.any(blk[1:] != blk[:-1], axis=1)) + 1
+    bounds = np.concatenate([[0], change, [len(cc)]]).astype(np.int64)
+
+    return order, bounds
+
+
+def bounded_map(executor, fn, items, window):
+    """executor.map() that keeps at most `window` tasks in flight
+    (results are yielded in order)
+    :param executor: concurrent.futures executor
+    :param fn: function to apply
+    :param items: iterable of arguments
+    :param window: maximum number of pending tasks
+    """
+    items = iter(items)
+    pending = [executor.submit(fn, it) for it in islice(items, window)]
+    while pending:
+        res = pending.pop(0).result()
+        for it in islice(items, 1):
+            pending.append(executor.submit(fn, it))
+        yield res
@@ -27,7 +27,9 @@ setup(
     packages=["bmtrap",
               ],
     entry_points={'console_scripts': [
-        'bmtrap=bmtrap.main:main'
+        'bmtrap=bmtrap.main:main',
+        'bmtrap-density=bmtrap.main:density_main',
+        'bmtrap-align=bmtrap.main:align_main'
     ]},
     url="https://github.com/chunglabmit/bmtrap_2021",
     license="MIT",